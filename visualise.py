@@ -2,89 +2,107 @@
 
 import os
 import re
+import glob
+import hashlib
 import time
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import json
 import argparse
-import random
+import colorsys
+from pathlib import Path
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import PatternMatchingEventHandler
 from PIL import Image, ImageDraw, ImageFont
 
 ##############################################################################
 # Balanced Parsing for defsrc/deflayer
 ##############################################################################
 
+# Comment patterns, compiled once since the config is re-parsed on every change.
+# The block-comment pattern is written as an unrolled loop (runs of non-'|',
+# then a '|' not followed by '#') so it matches in linear time without
+# backtracking on unterminated comments.
+_BLOCK_COMMENT_RE = re.compile(r"#\|[^|]*(?:\|(?!#)[^|]*)*\|#")
+_LINE_COMMENT_RE = re.compile(r";;.*?$", re.MULTILINE)
+_WHITESPACE_RE = re.compile(r"\s")
+_BLOCK_HEAD_RE = re.compile(r"\((defsrc|deflayer)\b")
+
 def find_top_level_expression(content, start_index):
     """
     Parse a balanced s-expression beginning at content[start_index].
     Returns (expr_string, next_index).
+
+    Jumps between parentheses with str.find rather than stepping through
+    every character in Python.
     """
-    stack = []
+    depth = 0
     i = start_index
     length = len(content)
-    while i < length:
-        if content[i] == '(':
-            stack.append('(')
-        elif content[i] == ')':
-            if not stack:
-                raise ValueError("Unmatched ')' at index {}".format(i))
-            stack.pop()
-            if not stack:
-                return content[start_index:i+1], i+1
-        i += 1
-    if stack:
-        raise ValueError("Unmatched '(' in expression starting at index {}".format(start_index))
-    return None, length
-
-
-def extract_defblocks(content, block_type="defsrc"):
+    open_i = content.find('(', i)
+    while True:
+        close_i = content.find(')', i)
+        if close_i == -1:
+            if depth or open_i != -1:
+                raise ValueError("Unmatched '(' in expression starting at index {}".format(start_index))
+            return None, length
+        if open_i != -1 and open_i < close_i:
+            depth += 1
+            i = open_i + 1
+            open_i = content.find('(', i)
+            continue
+        if not depth:
+            raise ValueError("Unmatched ')' at index {}".format(close_i))
+        depth -= 1
+        i = close_i + 1
+        if not depth:
+            return content[start_index:i], i
+
+
+def extract_defblocks(content):
     """
-    Extract top-level s-expressions of the form (defsrc ...) or (deflayer name ...).
-    Returns:
-      - for defsrc: a list of (None, body_string) (likely just one item),
-      - for deflayer: a list of (layer_name, body_string).
+    Extract top-level s-expressions of the form (defsrc ...) and (deflayer name ...)
+    in a single pass over the content.
+    Returns (defsrc_blocks, deflayer_blocks):
+      - defsrc_blocks: a list of body strings (likely just one item),
+      - deflayer_blocks: a list of (layer_name, body_string).
     """
-    results = []
-    idx = 0
-    while True:
-        found = content.find(f"({block_type}", idx)
-        if found == -1:
-            break
+    defsrc_blocks = []
+    deflayer_blocks = []
+    next_idx = 0
+    for m in _BLOCK_HEAD_RE.finditer(content):
+        found = m.start()
+        if found < next_idx:
+            # inside the block we've just extracted
+            continue
         try:
             expr_string, next_idx = find_top_level_expression(content, found)
         except ValueError as e:
             print(f"Warning: {e}")
-            idx = found + 1
             continue
 
         inner = expr_string.strip()[1:-1].strip()  # remove outer parentheses
         parts = inner.split(None, 1)
         if len(parts) < 2:
-            idx = next_idx
             continue
         block_keyword = parts[0]
         remainder = parts[1].strip()
-        if block_keyword == "defsrc" and block_type == "defsrc":
-            results.append((None, remainder))
-        elif block_keyword == "deflayer" and block_type == "deflayer":
+        if block_keyword != m.group(1):
+            # e.g. (defsrc-foo ...), which only shares a prefix
+            continue
+        if block_keyword == "defsrc":
+            defsrc_blocks.append(remainder)
+        else:
             # remainder should start with layerName
             remainder_parts = remainder.split(None, 1)
             if not remainder_parts:
-                idx = next_idx
                 continue
             layer_name = remainder_parts[0]
             layer_body = remainder_parts[1] if len(remainder_parts) > 1 else ""
-            results.append((layer_name, layer_body))
+            deflayer_blocks.append((layer_name, layer_body))
 
-        idx = next_idx
-    return results
-
-
-def find_top_level_expression_in_body(body, start_index):
-    """
-    Helper for split_top_level_forms.
-    """
-    return find_top_level_expression(body, start_index)
+    return defsrc_blocks, deflayer_blocks
 
 
 def split_top_level_forms(body):
@@ -92,31 +110,38 @@ def split_top_level_forms(body):
     Split a string with multiple tokens/s-expressions into a list of top-level forms.
     e.g. "abc (tap-hold 200 a (around lsft b)) def"
       -> ["abc", "(tap-hold 200 a (around lsft b))", "def"]
+
+    Runs of plain tokens between s-expressions are split with str.split; only
+    the s-expressions themselves go through the balanced-paren parser.
     """
+    if '(' not in body:
+        # The usual case for defsrc: nothing but plain tokens
+        return body.split()
+
     forms = []
     i = 0
     body_len = len(body)
     while i < body_len:
-        while i < body_len and body[i].isspace():
-            i += 1
-        if i >= body_len:
+        paren = body.find('(', i)
+        if paren == -1:
+            forms.extend(body[i:].split())
+            break
+        if paren > i and not body[paren-1].isspace():
+            # '(' inside a bare token: the token runs on to the next whitespace
+            ws = _WHITESPACE_RE.search(body, paren)
+            end = ws.start() if ws else body_len
+            forms.extend(body[i:end].split())
+            i = end
+            continue
+        forms.extend(body[i:paren].split())
+        try:
+            expr_string, next_i = find_top_level_expression(body, paren)
+            forms.append(expr_string)
+            i = next_i
+        except ValueError as e:
+            # If unmatched, just take the rest
+            forms.append(body[paren:].strip())
             break
-        if body[i] == '(':
-            try:
-                expr_string, next_i = find_top_level_expression_in_body(body, i)
-                forms.append(expr_string)
-                i = next_i
-            except ValueError as e:
-                # If unmatched, just take the rest
-                forms.append(body[i:].strip())
-                break
-        else:
-            # parse a token until whitespace
-            start = i
-            while i < body_len and not body[i].isspace():
-                i += 1
-            token = body[start:i]
-            forms.append(token)
     return forms
 
 
@@ -126,23 +151,34 @@ def parse_kmonad_config(filepath):
       defsrc_list: list of top-level forms in defsrc
       layer_dict: {layerName -> list of top-level forms in that layer's body}
     """
-    with open(filepath, 'r', encoding='utf-8') as f:
-        content = f.read()
+    return parse_kmonad_content(decode_kmonad_config(Path(filepath).read_bytes()))
 
+
+def decode_kmonad_config(data):
+    """
+    Decode raw config bytes as UTF-8 with newlines normalized to "\n", as a
+    text-mode read would, so multi-line forms match their expr_map keys.
+    """
+    return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def parse_kmonad_content(content):
+    """
+    Same as parse_kmonad_config, but for config text that has already been read.
+    """
     # Remove block comments and line comments
-    content = re.sub(r"#\|.*?\|#", "", content, flags=re.DOTALL)
-    content = re.sub(r";;.*?$", "", content, flags=re.MULTILINE)
+    content = _BLOCK_COMMENT_RE.sub("", content)
+    content = _LINE_COMMENT_RE.sub("", content)
+
+    defsrc_blocks, deflayer_blocks = extract_defblocks(content)
 
     # defsrc
-    defsrc_blocks = extract_defblocks(content, block_type="defsrc")
     defsrc_list = []
     if defsrc_blocks:
         # Just take the first
-        _, defsrc_body = defsrc_blocks[0]
-        defsrc_list = split_top_level_forms(defsrc_body)
+        defsrc_list = split_top_level_forms(defsrc_blocks[0])
 
     # deflayer
-    deflayer_blocks = extract_defblocks(content, block_type="deflayer")
     layer_dict = {}
     for (layer_name, layer_body) in deflayer_blocks:
         forms = split_top_level_forms(layer_body)
@@ -158,9 +194,11 @@ def parse_kmonad_config(filepath):
 def get_short_label(original: str, mapping: dict) -> str:
     """
     If `original` is in `mapping`, return mapping[original], else original.
+    Forms from split_top_level_forms carry no surrounding whitespace and
+    `mapping` keys are stripped when the map file is loaded, so no per-call
+    strip() is needed.
     """
-    stripped = original.strip()
-    return mapping.get(stripped, stripped)
+    return mapping.get(original, original)
 
 ##############################################################################
 # 3) Physical Layout Indirection
@@ -208,29 +246,33 @@ physical_rows = max_y + 1
 # 4) Generating a Single Image with Multiple Layer Assignments per Key
 ##############################################################################
 
-def generate_single_grid_image(defsrc_list, layer_dict, expr_map, out_path="kmonad_layout.png"):
+# We'll produce a grid of physical_rows x physical_cols
+CELL_WIDTH = 130
+# Increase the cell height to 140, as requested:
+CELL_HEIGHT = 180
+
+
+@functools.lru_cache(maxsize=1)
+def _get_fonts():
     """
-    1. We find each defsrc key in PHYSICAL_KEY_MAP. That gives us an index in defsrc_list
-       => we can retrieve that index from each layer.
-    2. For each physical key in PHYSICAL_KEY_MAP, we gather all layers' assigned values
-       if it appears in defsrc (otherwise it's "Not in defsrc").
-    3. We draw a single rectangle for each physical key, listing one line per layer
-       in that rectangle, each line in the layer's color. Also show the physical key name.
-    4. We draw a legend for the layers & their colors.
-    5. If the final short label is more than 10 chars, print it to stdout so the user can
-       add it to their alias file if they want.
-    6. For any assignment "XX", we display a blank instead of "XX".
+    Load (font, small_font) once; parsing the TTF is the slowest part of setup.
     """
+    try:
+        font = ImageFont.truetype("Arial.ttf", 16)
+        small_font = ImageFont.truetype("Arial.ttf", 14)
+    except:
+        font = ImageFont.load_default()
+        small_font = ImageFont.load_default()
+    return font, small_font
 
-    # 1) Build a mapping from defsrc key -> index
-    defsrc_index_for_key = {}
-    for i, keyname in enumerate(defsrc_list):
-        # if it matches a key in PHYSICAL_KEY_MAP, store i
-        if keyname in PHYSICAL_KEY_MAP:
-            defsrc_index_for_key[keyname] = i
 
-    # Sort layer names
-    layer_names = sorted(layer_dict.keys())
+@functools.lru_cache(maxsize=4)
+def _get_layer_layout(layer_names):
+    """
+    Return (layer_colors, (image_width, image_height, legend_height)) for a
+    sorted tuple of layer names. Cached, since the layer set rarely changes
+    between edits.
+    """
     # Assign each layer a color
     base_colors = [
         (230, 0, 0),
@@ -244,40 +286,59 @@ def generate_single_grid_image(defsrc_list, layer_dict, expr_map, out_path="kmon
         (100, 100, 200),
         (200, 100, 100)
     ]
-    # If we have more layers than base_colors, pick random for extras
+    # If we have more layers than base_colors, step around the HSV wheel by the
+    # golden ratio for extras, so colors are well spread and stable across runs
     layer_colors = {}
     idx = 0
-    import random
     for ln in layer_names:
         if idx < len(base_colors):
             layer_colors[ln] = base_colors[idx]
         else:
-            r = random.randint(0,200)
-            g = random.randint(0,200)
-            b = random.randint(0,200)
-            layer_colors[ln] = (r, g, b)
+            rgb = colorsys.hsv_to_rgb((idx * 0.3819) % 1.0, 0.6, 0.8)
+            layer_colors[ln] = tuple(int(c * 200) for c in rgb)
         idx += 1
 
-    # We'll produce a grid of physical_rows x physical_cols
-    cell_width = 130
-    # Increase the cell height to 140, as requested:
-    cell_height = 180
     # We also need space for a legend at the top
     legend_height = 50 + ((len(layer_names) + 3)//4)*20
-    image_width = physical_cols * cell_width
-    image_height = physical_rows * cell_height + legend_height
+    image_width = physical_cols * CELL_WIDTH
+    image_height = physical_rows * CELL_HEIGHT + legend_height
+    return layer_colors, (image_width, image_height, legend_height)
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_label_mask(label):
+    """
+    Rasterize `label` in the small font once and return ((dx, dy), mask): an
+    "L" mask plus its offset from the text origin. The same few labels repeat
+    across many keys and layers, so pasting a cached mask in the layer's color
+    avoids re-rendering the glyphs each time.
+    """
+    _, small_font = _get_fonts()
+    # textbbox (unlike font.getbbox) covers every line of a multi-line label
+    left, top, right, bottom = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox(
+        (0, 0), label, font=small_font)
+    left, top = min(left, 0), min(top, 0)
+    mask = Image.new("L", (max(right - left, 1), max(bottom - top, 1)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), label, font=small_font, fill=255)
+    return (left, top), mask
+
+
+@functools.lru_cache(maxsize=4)
+def _get_base_image(defsrc_keys, layer_names):
+    """
+    Draw everything that doesn't depend on the layer assignments: the legend,
+    every key outline and name, and the greyed-out "(Not in defsrc)" cells.
+    Keyed on the physical keys present in defsrc and the sorted layer names;
+    callers must copy() the result before drawing on it.
+    """
+    layer_colors, (image_width, image_height, legend_height) = _get_layer_layout(layer_names)
 
     img = Image.new("RGB", (image_width, image_height), color=(230,230,230))
     draw = ImageDraw.Draw(img)
 
-    try:
-        font = ImageFont.truetype("Arial.ttf", 16)
-        small_font = ImageFont.truetype("Arial.ttf", 14)
-    except:
-        font = ImageFont.load_default()
-        small_font = ImageFont.load_default()
+    font, small_font = _get_fonts()
 
-    # 2) Draw Legend at the top
+    # Legend at the top
     legend_x = 10
     legend_y = 10
     for i, ln in enumerate(layer_names):
@@ -288,71 +349,225 @@ def generate_single_grid_image(defsrc_list, layer_dict, expr_map, out_path="kmon
         draw.text((lx+25, ly), ln, font=small_font, fill=(0,0,0))
     grid_offset_y = legend_height
 
-    # 3) For each physical key in PHYSICAL_KEY_MAP
     for keyname, (cx, cy) in PHYSICAL_KEY_MAP.items():
-        px = cx * cell_width
-        py = grid_offset_y + cy * cell_height
+        px = cx * CELL_WIDTH
+        py = grid_offset_y + cy * CELL_HEIGHT
 
-        draw.rectangle([px, py, px+cell_width-2, py+cell_height-2],
+        draw.rectangle([px, py, px+CELL_WIDTH-2, py+CELL_HEIGHT-2],
                        outline=(0,0,0), width=1)
 
         # check if it's in defsrc
-        if keyname not in defsrc_index_for_key:
+        if keyname not in defsrc_keys:
             draw.text((px+5, py+5), keyname, font=font, fill=(150,150,150))
             draw.text((px+5, py+30), "(Not in defsrc)", font=small_font, fill=(120,120,120))
         else:
             draw.text((px+5, py+5), keyname, font=font, fill=(0,0,0))
-            i = defsrc_index_for_key[keyname]
-            line_y = py + 30
 
-            # gather each layer's assignment
-            for ln in layer_names:
-                color = layer_colors[ln]
-                layer_keys = layer_dict[ln]
-                if i < len(layer_keys):
-                    assigned = layer_keys[i]
-                else:
-                    assigned = "(N/A)"
+    return img
 
-                # For "XX" -> blank
-                if assigned == "XX":
-                    assigned = ""
 
-                # Possibly apply short label
-                short_assigned = get_short_label(assigned, expr_map)
+def _build_layer_labels(layer_dict, layer_names, defsrc_len, indices, expr_map):
+    """
+    Return labels[layer_idx][defsrc_idx], the final text for each displayed cell
+    ("" for cells not at one of `indices`). Also prints each distinct label
+    longer than 10 chars once, so the user can add it to their alias file if
+    they want.
+    """
+    labels = []
+    seen_long = set()
+    for ln in layer_names:
+        layer_keys = layer_dict[ln]
+        row = [""] * defsrc_len
+        for i in indices:
+            if i < len(layer_keys):
+                assigned = layer_keys[i]
+            else:
+                assigned = "(N/A)"
+
+            # For "XX" -> blank
+            if assigned == "XX":
+                assigned = ""
 
-                # If short_assigned == "XX", also replace with blank:
-                if short_assigned == "XX":
-                    short_assigned = ""
+            # Possibly apply short label
+            short_assigned = get_short_label(assigned, expr_map)
 
-                # If final label is > 10 chars, print to stdout
-                if len(short_assigned) > 10:
-                    print(f"Long label found (>{len(short_assigned)} chars): {short_assigned}")
+            # If short_assigned == "XX", also replace with blank:
+            if short_assigned == "XX":
+                short_assigned = ""
 
-                draw.text((px+5, line_y), short_assigned, font=small_font, fill=color)
+            # If final label is > 10 chars, print to stdout (once per label)
+            if len(short_assigned) > 10 and short_assigned not in seen_long:
+                seen_long.add(short_assigned)
+                print(f"Long label found (>{len(short_assigned)} chars): {short_assigned}")
+
+            row[i] = short_assigned
+        labels.append(row)
+    return labels
+
+
+def generate_single_grid_image(defsrc_list, layer_dict, expr_map, out_path="kmonad_layout.png"):
+    """
+    1. We find each defsrc key in PHYSICAL_KEY_MAP. That gives us an index in defsrc_list
+       => we can retrieve that index from each layer.
+    2. For each physical key in PHYSICAL_KEY_MAP, we gather all layers' assigned values
+       if it appears in defsrc (otherwise it's "Not in defsrc").
+    3. We draw a single rectangle for each physical key, listing one line per layer
+       in that rectangle, each line in the layer's color. Also show the physical key name.
+    4. We draw a legend for the layers & their colors.
+    5. If the final short label is more than 10 chars, print it to stdout so the user can
+       add it to their alias file if they want.
+    6. For any assignment "XX", we display a blank instead of "XX".
+    """
+
+    # 1) Build a mapping from defsrc key -> index
+    defsrc_index_for_key = {}
+    for i, keyname in enumerate(defsrc_list):
+        # if it matches a key in PHYSICAL_KEY_MAP, store i
+        if keyname in PHYSICAL_KEY_MAP:
+            defsrc_index_for_key[keyname] = i
+
+    # Sort layer names
+    layer_names = sorted(layer_dict.keys())
+    layer_colors, (image_width, image_height, legend_height) = _get_layer_layout(tuple(layer_names))
+
+    # 2) Resolve every displayed cell's final label up front, so the drawing
+    # loop below only pastes ready strings
+    labels = _build_layer_labels(layer_dict, layer_names, len(defsrc_list),
+                                 defsrc_index_for_key.values(), expr_map)
+
+    # 3) Copy the static part (legend, key outlines and names) from the cached base
+    img = _get_base_image(frozenset(defsrc_index_for_key), tuple(layer_names)).copy()
+    grid_offset_y = legend_height
+
+    # 4) For each physical key in defsrc, write the per-layer assignments
+    layer_rows = [(labels[li], layer_colors[ln]) for li, ln in enumerate(layer_names)]
+    for keyname, (cx, cy) in PHYSICAL_KEY_MAP.items():
+        if keyname in defsrc_index_for_key:
+            px = cx * CELL_WIDTH
+            py = grid_offset_y + cy * CELL_HEIGHT
+            i = defsrc_index_for_key[keyname]
+            line_y = py + 30
+            for row, color in layer_rows:
+                short_assigned = row[i]
+                if short_assigned:
+                    (dx, dy), mask = _get_label_mask(short_assigned)
+                    img.paste(color, (px+5+dx, line_y+dy), mask)
                 line_y += 15
 
-    img.save(out_path)
+    # The image is rewritten on every save, so favour encode speed over size.
+    # Drawing stays in RGB (Pillow only antialiases text there), but a 256-color
+    # palette copy is a third of the bytes to filter and deflate; the layout has
+    # a handful of flat colors plus antialiasing, so the loss isn't visible.
+    # Other suffixes (e.g. .bmp for a quick preview) use Pillow's defaults.
+    if out_path.lower().endswith(".png"):
+        img = img.quantize(256, method=Image.Quantize.FASTOCTREE)
+        img.save(out_path, "PNG", compress_level=1, optimize=False)
+    else:
+        img.save(out_path)
     print(f"Generated layout image: {out_path}")
 
 ##############################################################################
 # 5) Watchdog
 ##############################################################################
 
-class ConfigChangeHandler(FileSystemEventHandler):
+class ConfigChangeHandler(PatternMatchingEventHandler):
+    # Editors emit several modify events per save (write, truncate, rename);
+    # wait this long after the last one before regenerating.
+    DEBOUNCE_SECONDS = 0.2
+    # An mtime younger than this can still be shared by a later save on
+    # filesystems with coarse timestamps (FAT stores 2 s), with room for the
+    # debounce and queueing on top
+    MTIME_SLACK_NS = 5_000_000_000
+
     def __init__(self, kbd_path, expr_map):
-        super().__init__()
+        # Let watchdog drop events for other files in the directory (swap
+        # files, git, build output) before they reach Python callbacks. The name
+        # is escaped so it only ever matches itself. Matching is case-sensitive
+        # except on Windows, where watchdog then matches with PureWindowsPath
+        # (case-sensitive matching uses PurePosixPath, which can't split
+        # backslash paths) and the filesystem ignores case anyway.
+        super().__init__(patterns=[glob.escape(os.path.basename(kbd_path))],
+                         ignore_directories=True, case_sensitive=(os.name != "nt"))
         self.kbd_path = kbd_path
         self.expr_map = expr_map
+        # SHA-256 of the last content we rendered, so editors touching the
+        # file without changing it don't trigger a reparse + redraw.
+        self._last_hash = None
+        # Cheaper first check: if mtime and size haven't moved, don't even hash.
+        # Only recorded once the mtime is old enough that no later save could
+        # share it (see MTIME_SLACK_NS).
+        self._last_stat = None
+        # The last parse we rendered; comment/whitespace-only edits parse the
+        # same and don't need a redraw.
+        self._last_parse_key = None
+        self._timer = None
+        self._timer_lock = threading.Lock()
+        # Renders run one at a time on a single worker, with at most one more
+        # queued behind the running one (it reads the newest file when it starts)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
 
     def on_modified(self, event):
-        if event.is_directory:
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.DEBOUNCE_SECONDS, self._submit_regenerate)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _submit_regenerate(self):
+        with self._timer_lock:
+            pending = self._pending
+            if pending is not None and not pending.running() and not pending.done():
+                # Already queued and not started yet, so it will see this change
+                return
+            self._pending = self._executor.submit(self.regenerate)
+            self._pending.add_done_callback(self._report_error)
+
+    @staticmethod
+    def _report_error(future):
+        e = future.exception()
+        if e is not None:
+            print(f"Warning: could not regenerate layout image: {e}")
+
+    def regenerate(self, announce=True):
+        """
+        Re-read the config and redraw the layout image if it changed since the
+        last call. main() does the initial render through here too, so the
+        change-detection state starts out matching what's on disk.
+        """
+        try:
+            st = os.stat(self.kbd_path)
+            stat_key = (st.st_mtime_ns, st.st_size)
+            if stat_key == self._last_stat:
+                return
+            # Some filesystems only store mtimes to the second (or two), so a
+            # recent mtime can't rule out a newer save within the same tick
+            settled = time.time_ns() - st.st_mtime_ns >= self.MTIME_SLACK_NS
+            with open(self.kbd_path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            print(f"Warning: could not read {self.kbd_path}: {e}")
             return
-        if os.path.abspath(event.src_path) == os.path.abspath(self.kbd_path):
-            print("KMonad config changed; regenerating layout image...")
-            defsrc_list, layer_dict = parse_kmonad_config(self.kbd_path)
+        digest = hashlib.sha256(data).digest()
+        if digest == self._last_hash:
+            self._last_stat = stat_key if settled else None
+            return
+
+        defsrc_list, layer_dict = parse_kmonad_content(decode_kmonad_config(data))
+        parse_key = (tuple(defsrc_list),
+                     tuple((n, tuple(v)) for n, v in sorted(layer_dict.items())))
+        if parse_key != self._last_parse_key:
+            if announce:
+                print("KMonad config changed; regenerating layout image...")
             generate_single_grid_image(defsrc_list, layer_dict, self.expr_map, "kmonad_layout.png")
 
+        # Only remember this state once the image is written, so a failed
+        # decode or render is retried on the next event
+        self._last_hash = digest
+        self._last_parse_key = parse_key
+        self._last_stat = stat_key if settled else None
+
 
 ##############################################################################
 # 6) Main
@@ -368,17 +583,16 @@ def main():
     if args.map_file and os.path.isfile(args.map_file):
         try:
             with open(args.map_file, "r", encoding="utf-8") as f:
-                expr_map = json.load(f)
+                expr_map = {k.strip(): v for k, v in json.load(f).items()}
             print(f"Loaded expression map from {args.map_file}")
         except Exception as e:
             print(f"Warning: could not load map file: {e}")
 
     # Initial parse & image
-    defsrc_list, layer_dict = parse_kmonad_config(args.kbd_path)
-    generate_single_grid_image(defsrc_list, layer_dict, expr_map, "kmonad_layout.png")
+    handler = ConfigChangeHandler(args.kbd_path, expr_map)
+    handler.regenerate(announce=False)
 
     # Watch
-    handler = ConfigChangeHandler(args.kbd_path, expr_map)
     observer = Observer()
     watch_dir = os.path.dirname(os.path.abspath(args.kbd_path)) or "."
     observer.schedule(handler, path=watch_dir, recursive=False)